@@ -0,0 +1,44 @@
+# --- Варианты написания популярных городов рождения ---
+# Разные написания одного города сводятся к одному ключу кэша. Неоднозначные
+# сокращения (например, "ростов") намеренно не включены.
+
+# Название города и варианты написания (в нижнем регистре)
+CITIES = (
+    ("Москва", ("москва", "moscow", "moskva")),
+    ("Санкт-Петербург", ("санкт-петербург", "петербург", "спб", "питер", "saint petersburg", "st. petersburg")),
+    ("Киев", ("киев", "київ", "kyiv", "kiev")),
+    ("Харьков", ("харьков", "харків", "kharkiv", "kharkov")),
+    ("Одесса", ("одесса", "одеса", "odesa", "odessa")),
+    ("Днепр", ("днепр", "дніпро", "днепропетровск", "dnipro")),
+    ("Львов", ("львов", "львів", "lviv")),
+    ("Минск", ("минск", "мінск", "minsk")),
+    ("Новосибирск", ("новосибирск", "novosibirsk")),
+    ("Екатеринбург", ("екатеринбург", "yekaterinburg")),
+    ("Казань", ("казань", "kazan")),
+    ("Нижний Новгород", ("нижний новгород", "nizhny novgorod")),
+    ("Самара", ("самара", "samara")),
+    ("Ростов-на-Дону", ("ростов-на-дону", "rostov-on-don")),
+    ("Краснодар", ("краснодар", "krasnodar")),
+    ("Владивосток", ("владивосток", "vladivostok")),
+    ("Алматы", ("алматы", "алма-ата", "almaty")),
+    ("Астана", ("астана", "нур-султан", "astana")),
+    ("Ташкент", ("ташкент", "tashkent")),
+    ("Тбилиси", ("тбилиси", "tbilisi")),
+    ("Ереван", ("ереван", "yerevan")),
+    ("Баку", ("баку", "baku")),
+    ("Кишинёв", ("кишинёв", "кишинев", "chisinau")),
+    ("Рига", ("рига", "riga")),
+    ("Вильнюс", ("вильнюс", "vilnius")),
+    ("Таллин", ("таллин", "таллинн", "tallinn")),
+    ("Варшава", ("варшава", "warsaw")),
+    ("Берлин", ("берлин", "berlin")),
+    ("Лондон", ("лондон", "london")),
+    ("Нью-Йорк", ("нью-йорк", "new york")),
+)
+
+# Вариант написания -> единый ключ города (название из таблицы в нижнем регистре)
+CITY_CANONICAL = {
+    alias: name.lower()
+    for name, aliases in CITIES
+    for alias in (name.lower(), *aliases)
+}
@@ -1,9 +1,14 @@
+import asyncio
+import json
 import logging
 import os
-import psycopg2 # Импортируем библиотеку для работы с PostgreSQL
+import time
+from dataclasses import dataclass
+import asyncpg # Асинхронный драйвер PostgreSQL с пулом соединений
+import httpx # HTTP-клиент с общим пулом соединений для REST API Gemini
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-import google.generativeai as genai
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from city_aliases import CITY_CANONICAL # Варианты написания популярных городов
 
 # --- Настройка логирования ---
 logging.basicConfig(
@@ -15,6 +20,14 @@ logger = logging.getLogger(__name__)
 GET_BIRTH_DATE = 0
 GET_BIRTH_CITY = 1
 
+# Данные, собранные за время разговора с пользователем (хранятся в context.user_data['flow'])
+@dataclass(slots=True)
+class Flow:
+    birth_date: str = ""
+
+# Формат даты рождения ДД.ММ.ГГГГ (проверяется до обращения к Gemini)
+BIRTH_DATE_PATTERN = r'^\d{2}\.\d{2}\.\d{4}$'
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DATABASE_URL = os.getenv("DATABASE_URL") # Новая переменная для URL базы данных
@@ -29,65 +42,230 @@ if not GEMINI_API_KEY:
 if not DATABASE_URL:
     logger.error("DATABASE_URL не установлен в переменных окружения.")
     exit(1)
+if GEMINI_API_KEY == TELEGRAM_BOT_TOKEN:
+    # Токен бота вместо ключа Gemini приводит к ошибке 401 на каждом запросе
+    logger.error("GEMINI_API_KEY совпадает с TELEGRAM_BOT_TOKEN — проверьте переменные окружения.")
+    exit(1)
+
+# --- Настройки Gemini API ---
+GEMINI_MODEL_NAME = 'models/gemini-2.0-flash'
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/{GEMINI_MODEL_NAME}:streamGenerateContent"
+
+# Один клиент на весь процесс: соединения и TLS-сессии переиспользуются между запросами
+GEMINI_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+GEMINI_HTTP_TIMEOUT = 60
+
+# Настройки безопасности для запросов к Gemini (неизменяемый кортеж, создается один раз)
+SAFETY_SETTINGS = (
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+)
+
+# Шаблон запроса к Gemini; подставляются только дата и город
+PROMPT_TMPL = (
+    "Создай очень краткую и обобщенную натальную карту для человека, "
+    "родившегося {date} в городе {city}. "
+    "Включи общие характеристики личности, основные планетарные влияния (например, знак зодиака по Солнцу, асцендент, лунный знак - если возможно из общих данных)."
+    "Представь информацию в формате, удобном для чтения, без излишних астрологических терминов."
+).format_map
+
+# --- Настройки потоковой генерации ---
+# Частота редактирования сообщения с частичным ответом (не чаще раза в секунду или 200 символов)
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_EDIT_CHARS = 200
+
+# --- Настройки фоновой записи в базу данных ---
+WRITE_QUEUE_SIZE = 1000
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_DELAY = 0.1 # Пауза для накопления пачки записей, в секундах
+
+# --- SQL-запросы ---
+BIRTH_CITY_MAX_LENGTH = 255 # Совпадает с birth_city VARCHAR(255)
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS natal_readings (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        birth_date VARCHAR(10) NOT NULL,
+        birth_city VARCHAR(255) NOT NULL,
+        gemini_response TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
 
-# --- Инициализация Gemini API ---
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('models/gemini-2.0-flash')
+# Ключ кэша по городу вычисляется в Python (normalize_city) и хранится отдельно,
+# чтобы при записи и при поиске нормализация была одной и той же
+CREATE_CITY_KEY_COLUMN_SQL = """
+    ALTER TABLE natal_readings ADD COLUMN IF NOT EXISTS city_key TEXT;
+"""
+
+# Записи, сохраненные до появления city_key, заполняются при запуске тем же normalize_city
+SELECT_MISSING_CITY_KEYS_SQL = """
+    SELECT id, birth_city FROM natal_readings WHERE city_key IS NULL;
+"""
+
+UPDATE_CITY_KEY_SQL = """
+    UPDATE natal_readings SET city_key = $2 WHERE id = $1;
+"""
+
+# Индекс по ключу кэша (дата, город)
+CREATE_CACHE_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS nr_date_city_key ON natal_readings (birth_date, city_key);
+"""
+
+SELECT_CACHED_READING_SQL = """
+    SELECT gemini_response FROM natal_readings
+    WHERE birth_date = $1 AND city_key = $2
+    ORDER BY created_at DESC
+    LIMIT 1;
+"""
+
+# Запрос хранится как константа: asyncpg кэширует подготовленный оператор
+# на каждом соединении пула, если текст запроса совпадает дословно.
+INSERT_READING_SQL = """
+    INSERT INTO natal_readings (user_id, birth_date, birth_city, city_key, gemini_response)
+    VALUES ($1, $2, $3, $4, $5);
+"""
+
+# --- Запросы к Gemini ---
+
+async def stream_gemini_response(client: httpx.AsyncClient, prompt_text: str):
+    """Отправляет запрос в Gemini и по частям возвращает текст ответа."""
+    async with client.stream(
+        "POST",
+        GEMINI_STREAM_URL,
+        params={"alt": "sse"},
+        headers={"x-goog-api-key": GEMINI_API_KEY},
+        json={
+            "contents": [{"parts": [{"text": prompt_text}]}],
+            "safetySettings": SAFETY_SETTINGS,
+        },
+    ) as response:
+        response.raise_for_status()
+        # Ответ приходит в формате server-sent events: одна строка "data: {...}" на фрагмент
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            for candidate in data.get("candidates", [])[:1]:
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
 
 # --- Функции для работы с базой данных ---
 
-def get_db_connection():
-    """Устанавливает соединение с базой данных PostgreSQL."""
-    conn = None
+def normalize_city(birth_city: str) -> str:
+    """Приводит название города к ключу кэша; известные варианты написания — к одному ключу."""
+    city_key = birth_city.strip().lower()
+    return CITY_CANONICAL.get(city_key, city_key)
+
+async def get_cached_reading(pool: asyncpg.Pool, birth_date: str, birth_city: str) -> str | None:
+    """Ищет ранее сгенерированный ответ для той же даты и города."""
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        logger.info("Успешно подключено к базе данных PostgreSQL.")
-        return conn
+        async with pool.acquire() as con:
+            row = await con.fetchrow(SELECT_CACHED_READING_SQL, birth_date, normalize_city(birth_city))
+        return row['gemini_response'] if row else None
     except Exception as e:
-        logger.error(f"Ошибка подключения к базе данных: {e}")
+        logger.error("Ошибка при чтении кэша из базы данных: %s", e)
         return None
 
-def create_table_if_not_exists():
-    """Создает таблицу natal_readings, если она еще не существует."""
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS natal_readings (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    birth_date VARCHAR(10) NOT NULL,
-                    birth_city VARCHAR(255) NOT NULL,
-                    gemini_response TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            conn.commit()
-            logger.info("Таблица natal_readings проверена/создана.")
-        except Exception as e:
-            logger.error(f"Ошибка при создании таблицы: {e}")
-        finally:
-            if conn:
-                conn.close()
-
-async def save_reading_to_db(user_id: int, birth_date: str, birth_city: str, gemini_response: str):
-    """Сохраняет данные натальной карты в базу данных."""
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO natal_readings (user_id, birth_date, birth_city, gemini_response)
-                VALUES (%s, %s, %s, %s);
-            """, (user_id, birth_date, birth_city, gemini_response))
-            conn.commit()
-            logger.info(f"Запись для пользователя {user_id} успешно сохранена в БД.")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении в базу данных: {e}")
-        finally:
-            if conn:
-                conn.close()
+async def save_readings_to_db(pool: asyncpg.Pool, records: list[tuple]):
+    """Сохраняет пачку натальных карт в базу данных одним обращением."""
+    try:
+        async with pool.acquire() as con:
+            try:
+                await con.executemany(INSERT_READING_SQL, records)
+                logger.info("В БД успешно сохранено записей: %d.", len(records))
+                return
+            except Exception as e:
+                # executemany выполняется в одной транзакции: одна плохая запись отменяет всю пачку,
+                # поэтому сохраняем записи по одной, чтобы потерять только ошибочные
+                logger.error("Ошибка при сохранении пачки из %d записей, сохраняем по одной: %s", len(records), e)
+            saved = 0
+            for record in records:
+                try:
+                    await con.execute(INSERT_READING_SQL, *record)
+                    saved += 1
+                except Exception as e:
+                    logger.error("Ошибка при сохранении записи пользователя %s: %s", record[0], e)
+            logger.info("В БД сохранено записей по одной: %d из %d.", saved, len(records))
+    except Exception as e:
+        logger.error("Ошибка при сохранении в базу данных: %s", e)
+
+async def db_writer(pool: asyncpg.Pool, queue: asyncio.Queue):
+    """Фоновая задача: собирает записи из очереди и сохраняет их пачками."""
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(WRITE_BATCH_DELAY)
+        while not queue.empty() and len(batch) < WRITE_BATCH_SIZE:
+            batch.append(queue.get_nowait())
+        # None в очереди — сигнал остановки от post_shutdown
+        records = [record for record in batch if record is not None]
+        if records:
+            await save_readings_to_db(pool, records)
+        if len(records) != len(batch):
+            return
+
+# --- Жизненный цикл приложения ---
+
+async def post_init(application: Application) -> None:
+    """Создает пул соединений с базой данных и HTTP-клиент Gemini при запуске бота."""
+    application.bot_data['http_client'] = httpx.AsyncClient(
+        limits=GEMINI_HTTP_LIMITS, http2=True, timeout=GEMINI_HTTP_TIMEOUT
+    )
+    pool = await asyncpg.create_pool(DATABASE_URL, min_size=2, max_size=10, statement_cache_size=128)
+    application.bot_data['db_pool'] = pool
+    logger.info("Пул соединений с базой данных PostgreSQL создан.")
+    # Создаем таблицу, если ее нет, на уже открытом соединении пула
+    try:
+        async with pool.acquire() as con:
+            await con.execute(CREATE_TABLE_SQL)
+            await con.execute(CREATE_CITY_KEY_COLUMN_SQL)
+            await con.execute(CREATE_CACHE_INDEX_SQL)
+        logger.info("Таблица natal_readings проверена/создана.")
+    except Exception as e:
+        logger.error("Ошибка при создании таблицы: %s", e)
+    # Заполняем ключ кэша для старых записей, чтобы они тоже отдавались из кэша
+    try:
+        async with pool.acquire() as con:
+            rows = await con.fetch(SELECT_MISSING_CITY_KEYS_SQL)
+            if rows:
+                await con.executemany(
+                    UPDATE_CITY_KEY_SQL,
+                    [(row['id'], normalize_city(row['birth_city'])) for row in rows],
+                )
+                logger.info("Ключ кэша заполнен для старых записей: %d.", len(rows))
+    except Exception as e:
+        logger.error("Ошибка при заполнении ключа кэша для старых записей: %s", e)
+    # Запись ответов в базу данных вынесена из обработчиков в фоновую задачу
+    queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    application.bot_data['write_queue'] = queue
+    application.bot_data['db_writer'] = asyncio.create_task(db_writer(pool, queue))
+
+async def post_shutdown(application: Application) -> None:
+    """Закрывает пул соединений с базой данных и HTTP-клиент Gemini при остановке бота."""
+    client = application.bot_data.pop('http_client', None)
+    if client:
+        await client.aclose()
+    # Дожидаемся записи всех ответов из очереди до закрытия пула
+    writer = application.bot_data.pop('db_writer', None)
+    if writer:
+        if writer.done():
+            # Задача могла завершиться с ошибкой раньше — ждать ее уже нечего
+            if not writer.cancelled() and writer.exception():
+                logger.error("Фоновая запись в БД завершилась с ошибкой: %s", writer.exception())
+        else:
+            try:
+                await application.bot_data['write_queue'].put(None)
+                await writer
+            except Exception as e:
+                logger.error("Ошибка при остановке фоновой записи в БД: %s", e)
+    pool = application.bot_data.pop('db_pool', None)
+    if pool:
+        await pool.close()
+        logger.info("Пул соединений с базой данных закрыт.")
 
 # --- Функции-обработчики команд и сообщений ---
 
@@ -95,6 +273,7 @@ async def save_reading_to_db(user_id: int, birth_date: str, birth_city: str, gem
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отправляет приветственное сообщение и запрашивает дату рождения."""
     user = update.effective_user
+    context.user_data['flow'] = Flow()
     await update.message.reply_html(
         f"Привет, {user.mention_html()}! Я могу помочь тебе узнать немного о твоей натальной карте. "
         "Пожалуйста, введи свою дату рождения в формате ДД.ММ.ГГГГ (например, 01.01.2000):"
@@ -105,51 +284,83 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def get_birth_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получает дату рождения и запрашивает город."""
     user_birth_date = update.message.text
-    context.user_data['birth_date'] = user_birth_date
+    context.user_data['flow'].birth_date = user_birth_date
     await update.message.reply_text(
         "Отлично! Теперь, пожалуйста, введи город твоего рождения:"
     )
     return GET_BIRTH_CITY
 
+# Обработчик для даты рождения в неверном формате
+async def invalid_birth_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Просит повторно ввести дату рождения в формате ДД.ММ.ГГГГ."""
+    await update.message.reply_text(
+        "Пожалуйста, введи дату рождения в формате ДД.ММ.ГГГГ (например, 01.01.2000):"
+    )
+    return GET_BIRTH_DATE
+
 # Обработчик для получения города рождения и отправки запроса в Gemini
 async def get_birth_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получает город рождения, формирует запрос для Gemini и отправляет ответ."""
     user = update.effective_user
     user_id = user.id
     user_birth_city = update.message.text
-    birth_date = context.user_data['birth_date']
+    birth_date = context.user_data['flow'].birth_date
+    pool = context.bot_data['db_pool']
 
-    await update.message.reply_text("Спасибо! Генерирую информацию по твоей натальной карте. Это может занять немного времени...")
+    # Та же дата и тот же город дают тот же запрос — отвечаем из кэша без обращения к Gemini
+    cached_response = await get_cached_reading(pool, birth_date, user_birth_city)
+    if cached_response:
+        await update.message.reply_text(cached_response)
+        return ConversationHandler.END
 
-    prompt_text = (
-        f"Создай очень краткую и обобщенную натальную карту для человека, "
-        f"родившегося {birth_date} в городе {user_birth_city}. "
-        "Включи общие характеристики личности, основные планетарные влияния (например, знак зодиака по Солнцу, асцендент, лунный знак - если возможно из общих данных)."
-        "Представь информацию в формате, удобном для чтения, без излишних астрологических терминов."
-    )
+    progress_message = await update.message.reply_text("Спасибо! Генерирую информацию по твоей натальной карте. Это может занять немного времени...")
+
+    prompt_text = PROMPT_TMPL({'date': birth_date, 'city': user_birth_city})
 
     gemini_response_text = "" # Инициализируем пустой строкой
+    sent_text = "" # Текст, уже показанный пользователю в progress_message
     try:
-        response = model.generate_content(
-            prompt_text,
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-        )
-        gemini_response_text = response.text
-        await update.message.reply_text(gemini_response_text)
+        # Асинхронный вызов не блокирует цикл событий на время генерации,
+        # а потоковый режим показывает ответ по мере его появления
+        last_edit = time.monotonic()
+        async for chunk_text in stream_gemini_response(context.bot_data['http_client'], prompt_text):
+            gemini_response_text += chunk_text
+            if gemini_response_text != sent_text and (
+                time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL
+                or len(gemini_response_text) - len(sent_text) >= STREAM_EDIT_CHARS
+            ):
+                await progress_message.edit_text(gemini_response_text)
+                sent_text = gemini_response_text
+                last_edit = time.monotonic()
 
-        # Сохраняем данные в базу данных после успешного получения ответа
-        await save_reading_to_db(user_id, birth_date, user_birth_city, gemini_response_text)
+        if not gemini_response_text:
+            raise ValueError("Gemini вернул пустой ответ")
+        if gemini_response_text != sent_text:
+            await progress_message.edit_text(gemini_response_text)
 
-    except Exception as e:
-        logger.error(f"Ошибка при обращении к Gemini API: {e}")
-        await update.message.reply_text(
-            "Извини, произошла ошибка при получении информации от Gemini. Попробуй еще раз позже."
+        # Сохраняем данные в базу данных после успешного получения ответа (в фоне)
+        # Сообщение Telegram может быть длиннее колонки birth_city — обрезаем, чтобы запись не отвергла БД
+        record = (
+            user_id, birth_date, user_birth_city[:BIRTH_CITY_MAX_LENGTH],
+            normalize_city(user_birth_city), gemini_response_text,
         )
+        try:
+            context.bot_data['write_queue'].put_nowait(record)
+        except asyncio.QueueFull:
+            await save_readings_to_db(pool, [record])
+
+    except Exception as e:
+        logger.error("Ошибка при обращении к Gemini API: %s", e)
+        error_text = "Извини, произошла ошибка при получении информации от Gemini. Попробуй еще раз позже."
+        # Обрезанный ответ не должен остаться на экране, будто он полный
+        if sent_text:
+            try:
+                await progress_message.edit_text(error_text)
+            except Exception as edit_error:
+                logger.error("Не удалось заменить частичный ответ сообщением об ошибке: %s", edit_error)
+                await update.message.reply_text(error_text)
+        else:
+            await update.message.reply_text(error_text)
 
     return ConversationHandler.END
 
@@ -157,7 +368,7 @@ async def get_birth_city(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет и завершает текущий разговор."""
     user = update.effective_user
-    logger.info(f"Пользователь {user.first_name} отменил разговор.")
+    logger.info("Пользователь %s отменил разговор.", user.first_name)
     await update.message.reply_text(
         'Диалог отменен. Если хочешь начать сначала, используй команду /start.'
     )
@@ -170,15 +381,27 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Основная функция для запуска бота ---
 def main() -> None:
     """Запускает бота."""
-    # Создаем таблицу, если ее нет, при запуске бота
-    create_table_if_not_exists()
-
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Ограничитель выравнивает исходящие сообщения под лимиты Telegram вместо ответов 429
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30, overall_time_period=1,
+            group_max_rate=20, group_time_period=60,
+            max_retries=3,
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
-            GET_BIRTH_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_birth_date)],
+            GET_BIRTH_DATE: [
+                MessageHandler(filters.Regex(BIRTH_DATE_PATTERN), get_birth_date),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, invalid_birth_date),
+            ],
             GET_BIRTH_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_birth_city)],
         },
         fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.COMMAND | filters.TEXT, unknown)],